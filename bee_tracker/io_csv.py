@@ -1,27 +1,303 @@
 #!/usr/bin/env python
 
+import concurrent.futures
+import gzip
+import io
+import os.path
+import queue
 import sys
+import threading
 
-import pandas
+import numpy
 
 import bee_tracker.bee
+import bee_tracker.table
 
 
-def loadCSVDataFrame(path):
-    '''Loads the bee data from a CSV file as a set of vectors.
-    Returns the following vectors: ids, tags, frames, x coordinates and y
-    coordinates.
-    '''
-    dtype = {'BeeID': int,
+CSV_DTYPE = {'BeeID': int,
              'Tag'  : int,
              'Frame': int,
              'X'    : float,
              'Y'    : float}
-    df    = pandas.read_csv(path,
-                            engine='c',
-                            comment='#',
-                            dtype=dtype)
-    return df
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Files above this size are parsed faster by pandas, even counting the time
+# taken to import it
+NUMPY_MAX_SIZE = 1 << 23
+
+def detectCompression(path):
+    '''Returns 'gzip', 'zstd' or None, based on the first bytes of the file
+    '''
+    with open(path, 'rb') as handle:
+        magic = handle.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+def openDecompressed(path, compression):
+    '''Opens a file as a binary stream of decompressed data
+    '''
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstandard module is required to read %s' % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+def readBlocks(handle, blockSize, blocks, stop):
+    '''Reads a stream in blocks of whole lines of about blockSize bytes and
+    puts them in a queue, followed by None. Errors are put in the queue.
+    Gives up as soon as the stop event is set, even if the queue is full.
+    '''
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        remainder = b''
+        while not stop.is_set():
+            data = handle.read(blockSize)
+            if not data:
+                break
+            data   = remainder + data
+            cut    = data.rfind(b'\n') + 1
+            if cut == 0:
+                remainder = data
+                continue
+            remainder = data[cut:]
+            if not put(data[:cut]):
+                return
+        if remainder and not put(remainder):
+            return
+        put(None)
+    except Exception as e:
+        put(e)
+
+def parseBlock(block, names):
+    import pandas
+    return pandas.read_csv(io.BytesIO(block),
+                           engine='c',
+                           comment='#',
+                           header=None,
+                           names=names,
+                           dtype=CSV_DTYPE)
+
+def loadCSVDataFrameBlocks(path, compression, threads, blockSize=1 << 22):
+    '''Loads a possibly compressed CSV file with a decompression thread that
+    cuts the data into blocks of whole lines, and a pool of threads parsing
+    the blocks. The result is the same as with pandas.read_csv.
+    '''
+    import pandas
+    blocks = queue.Queue(maxsize=2 * threads)
+    stop   = threading.Event()
+    handle = openDecompressed(path, compression)
+    reader = threading.Thread(target=readBlocks, args=(handle, blockSize, blocks, stop))
+    reader.daemon = True
+    reader.start()
+    names   = None
+    futures = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            try:
+                while True:
+                    block = blocks.get()
+                    if block is None:
+                        break
+                    if isinstance(block, Exception):
+                        raise block
+                    if names is None:
+                        # The header is the first line that is not empty or a
+                        # comment
+                        lines = block.split(b'\n')
+                        for i, line in enumerate(lines):
+                            line = line.split(b'#')[0].strip()
+                            if line:
+                                names = [x.strip() for x in line.decode().split(',')]
+                                block = b'\n'.join(lines[i + 1:])
+                                break
+                        if names is None:
+                            continue
+                    futures.append(executor.submit(parseBlock, block, names))
+                dfs = [x.result() for x in futures]
+            except BaseException:
+                # Do not parse the remaining blocks after an error
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        # Unblock and stop the reader, whatever happened, so that it does not
+        # keep the file and the blocks alive
+        stop.set()
+        try:
+            while True:
+                blocks.get_nowait()
+        except queue.Empty:
+            pass
+        reader.join()
+        handle.close()
+    if len(dfs) == 0:
+        return pandas.read_csv(io.StringIO(','.join(names or [])), dtype=CSV_DTYPE)
+    return pandas.concat(dfs, ignore_index=True)
+
+def loadCSVDataFrame(path, threads=1):
+    '''Loads the bee data from a CSV file as a set of vectors.
+    Returns the following vectors: ids, tags, frames, x coordinates and y
+    coordinates.
+    Compressed files (gzip or zstd), or any file when threads > 1, are
+    decompressed and parsed in parallel blocks.
+    '''
+    import pandas
+    compression = detectCompression(path)
+    if compression is None and threads <= 1:
+        df = pandas.read_csv(path,
+                             engine='c',
+                             comment='#',
+                             dtype=CSV_DTYPE)
+        return df
+    return loadCSVDataFrameBlocks(path, compression, max(threads, 1))
+
+def usesNumPy(path, threads=1):
+    '''Whether the auto engine of loadCSVTable reads a file with NumPy
+    '''
+    return (threads <= 1 and
+            os.path.getsize(path) < NUMPY_MAX_SIZE and
+            detectCompression(path) is None)
+
+def loadCSVTable(path, threads=1, engine='auto'):
+    '''Loads the bee data from a CSV file as a Table.
+    engine: 'numpy' reads the file with NumPy alone, which avoids the cost
+    of importing pandas for small files; 'pandas' uses loadCSVDataFrame;
+    'auto' uses NumPy for uncompressed files under NUMPY_MAX_SIZE bytes read
+    with a single thread, and pandas otherwise or if NumPy can not parse the
+    file, so that it accepts the same files as pandas.
+    '''
+    if engine == 'auto':
+        engine = 'pandas'
+        if usesNumPy(path, threads):
+            try:
+                return bee_tracker.table.readCSV(path, CSV_DTYPE)
+            except ValueError:
+                pass
+    if engine == 'numpy':
+        return bee_tracker.table.readCSV(path, CSV_DTYPE)
+    df = loadCSVDataFrame(path, threads)
+    return bee_tracker.table.Table(dict((x, df[x].values) for x in df.columns))
+
+class ValidationReport:
+    '''Summary of the problems found while normalising a recording
+    '''
+
+    fileName = 'validation.csv'
+
+    def __init__(self):
+        self.nRecords       = 0
+        self.wasSorted      = True
+        self.nDuplicates    = 0
+        self.nDropped       = 0
+        self.nBadCoords     = 0
+        self.nDroppedCoords = 0
+        self.nUnknownTags   = 0
+        # -1 when the tags were not checked, see normalizeDataFrame
+        self.nInvalidTags   = -1
+
+    def asTable(self):
+        return bee_tracker.table.Table({'records'       : [self.nRecords],
+                                        'sorted'        : [int(self.wasSorted)],
+                                        'duplicates'    : [self.nDuplicates],
+                                        'dropped'       : [self.nDropped],
+                                        'bad_coords'    : [self.nBadCoords],
+                                        'dropped_coords': [self.nDroppedCoords],
+                                        'unknown_tags'  : [self.nUnknownTags],
+                                        'invalid_tags'  : [self.nInvalidTags]})
+
+    def write(self, outDir):
+        path = os.path.join(outDir, ValidationReport.fileName)
+        self.asTable().to_csv(path, index=False)
+
+    def __str__(self):
+        invalidTags = 'n/a' if self.nInvalidTags < 0 else str(self.nInvalidTags)
+        return ('%d records, sorted: %s, %d duplicates (%d dropped), '
+                '%d bad coordinates (%d dropped), %d unknown tags, %s invalid tags' %
+                (self.nRecords, self.wasSorted, self.nDuplicates,
+                 self.nDropped, self.nBadCoords, self.nDroppedCoords,
+                 self.nUnknownTags, invalidTags))
+
+def normalizeDataFrame(df,
+                       dropDuplicates=True,
+                       xRange=None,
+                       yRange=None,
+                       knownTags=None,
+                       dropBadCoords=False):
+    '''Makes sure the records are sorted by (BeeID, Frame) and that each
+    (BeeID, Frame) pair is unique, as assumed by the Bee objects.
+    Works on a Table as well as on a pandas DataFrame.
+    The data frame is only sorted if it needs to be, with a stable sort so
+    that the first of duplicated records is the one kept.
+    Coordinates that are not finite or outside of xRange / yRange are
+    counted, and only removed with dropBadCoords: otherwise the following
+    stages get the NaN and out of range coordinates as they are.
+    The records with Bee.UNKNOWN_TAG are counted, and when knownTags is
+    given, the tags that are neither in knownTags nor Bee.UNKNOWN_TAG are
+    counted as invalid; neither is removed.
+    Returns the normalised data frame and a ValidationReport.
+    '''
+    report          = ValidationReport()
+    report.nRecords = len(df)
+    if len(df) == 0:
+        if not knownTags is None:
+            report.nInvalidTags = 0
+        return df, report
+    ids    = numpy.asarray(df['BeeID'])
+    frames = numpy.asarray(df['Frame'])
+    # Sorted if each id is larger than the previous one, or equal with a
+    # frame that is not smaller
+    sameId  = ids[1:] == ids[:-1]
+    inOrder = (ids[1:] > ids[:-1]) | (sameId & (frames[1:] >= frames[:-1]))
+    if not inOrder.all():
+        report.wasSorted = False
+        order  = numpy.lexsort((frames, ids))
+        df     = bee_tracker.table.takeRows(df, order)
+        ids    = numpy.asarray(df['BeeID'])
+        frames = numpy.asarray(df['Frame'])
+        sameId = ids[1:] == ids[:-1]
+    # Once sorted, duplicates are adjacent
+    duplicates         = numpy.zeros(len(df), dtype=bool)
+    duplicates[1:]     = sameId & (frames[1:] == frames[:-1])
+    report.nDuplicates = int(duplicates.sum())
+    if dropDuplicates and report.nDuplicates > 0:
+        df              = bee_tracker.table.takeRows(df, ~duplicates)
+        report.nDropped = report.nDuplicates
+    xs        = numpy.asarray(df['X'])
+    ys        = numpy.asarray(df['Y'])
+    badCoords = ~(numpy.isfinite(xs) & numpy.isfinite(ys))
+    if not xRange is None:
+        badCoords |= (xs < xRange[0]) | (xs > xRange[1])
+    if not yRange is None:
+        badCoords |= (ys < yRange[0]) | (ys > yRange[1])
+    report.nBadCoords = int(badCoords.sum())
+    if dropBadCoords and report.nBadCoords > 0:
+        df                    = bee_tracker.table.takeRows(df, ~badCoords)
+        report.nDroppedCoords = report.nBadCoords
+    tags                = numpy.asarray(df['Tag'])
+    report.nUnknownTags = int((tags == bee_tracker.bee.Bee.UNKNOWN_TAG).sum())
+    if not knownTags is None:
+        validTags           = list(knownTags) + [bee_tracker.bee.Bee.UNKNOWN_TAG]
+        invalid             = ~numpy.isin(tags, validTags)
+        report.nInvalidTags = int(invalid.sum())
+    return df, report
 
 def createBeesFromDataFrame(df, minSize=0):
     '''Creates a dictionary of bee objects indexed by bee id based on vectors
@@ -48,19 +324,11 @@ def loadBeesCSV(path):
     '''
     #vectors = loadCSVLists(path)
     #bees = createBeesFromList(*vectors)
-    df   = loadCSVDataFrame(path)
-    bees = createBeesFromDataFrame(df)
+    df         = loadCSVDataFrame(path)
+    df, report = normalizeDataFrame(df)
+    bees       = createBeesFromDataFrame(df)
     return bees
 
-def filterBees(bees, filterFunction, description):
-    toRemove = []
-    for beeId in bees:
-        if not filterFunction(bees[beeId]):
-            toRemove.append(beeId)
-    for beeId in toRemove:
-        del bees[beeId]
-    sys.stderr.write('%s filter: %d bees removed\n' % (description, filterFunction))
-
 def main():
     import os.path
     if len(sys.argv) !=2:
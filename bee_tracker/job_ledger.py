@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import contextlib
+import fcntl
+import json
+import os
+import os.path
+import socket
+import sys
+import time
+
+
+class JobLedger:
+    '''An on-disk record of the state of each recording of a batch.
+    The ledger is a JSON file in the output directory, indexed by job name,
+    that is always rewritten atomically. All the accesses are serialised with
+    a lock on a separate file, so that several processes, possibly on several
+    machines sharing the output directory, can claim jobs from the same
+    ledger and resume an interrupted batch.
+    '''
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE    = 'done'
+    FAILED  = 'failed'
+
+    fileName = 'jobs.ledger.json'
+    lockName = 'jobs.ledger.lock'
+
+    def __init__(self, outDir, maxAttempts=3, staleAfter=None):
+        '''outDir: directory holding the ledger
+        maxAttempts: maximum number of times a job is started before it is
+        left as failed
+        staleAfter: number of seconds after which a running job is considered
+        abandoned (e.g. its node was pre-empted) and can be claimed again.
+        If None, running jobs are only reclaimed when their process, on this
+        host, no longer exists.
+        '''
+        self.outDir      = outDir
+        self.path        = os.path.join(outDir, JobLedger.fileName)
+        self.lockPath    = os.path.join(outDir, JobLedger.lockName)
+        self.maxAttempts = maxAttempts
+        self.staleAfter  = staleAfter
+
+    @contextlib.contextmanager
+    def locked(self):
+        '''Holds the ledger lock for the duration of a with block
+        '''
+        if not os.path.exists(self.outDir):
+            os.makedirs(self.outDir, exist_ok=True)
+        with open(self.lockPath, 'a') as handle:
+            fcntl.lockf(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(handle, fcntl.LOCK_UN)
+
+    def load(self):
+        '''Returns the content of the ledger, an empty ledger if it does not
+        exist yet. Must be called with the lock held.
+        '''
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as handle:
+            return json.load(handle)
+
+    def save(self, jobs):
+        '''Atomically replaces the ledger. Must be called with the lock held.
+        '''
+        tmpPath = '%s.%s.%d.tmp' % (self.path, socket.gethostname(), os.getpid())
+        with open(tmpPath, 'w') as handle:
+            json.dump(jobs, handle, indent=1, sort_keys=True)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmpPath, self.path)
+
+    def register(self, names):
+        '''Adds the jobs that are not in the ledger yet as pending.
+        '''
+        with self.locked():
+            jobs    = self.load()
+            changed = False
+            for name in names:
+                if not name in jobs:
+                    jobs[name] = {'state'   : JobLedger.PENDING,
+                                  'attempts': 0}
+                    changed    = True
+            if changed:
+                self.save(jobs)
+
+    def isAbandoned(self, job, now):
+        '''Whether a running job was left by a process that died, or has
+        been running for longer than staleAfter
+        '''
+        if not self.staleAfter is None and now - job['started'] > self.staleAfter:
+            return True
+        if job.get('host') != socket.gethostname():
+            return False
+        try:
+            os.kill(job['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # The process exists but belongs to another user
+            return False
+        return False
+
+    def isOutdated(self, job, fingerprint):
+        '''Whether a finished job was run on another input or with other
+        options
+        '''
+        return (job['state'] in (JobLedger.DONE, JobLedger.FAILED) and
+                job.get('fingerprint') != fingerprint)
+
+    def isClaimable(self, job, now, fingerprint=None):
+        if self.isOutdated(job, fingerprint):
+            return True
+        if job['state'] == JobLedger.PENDING:
+            return True
+        if job['state'] == JobLedger.FAILED:
+            return job['attempts'] < self.maxAttempts
+        if job['state'] == JobLedger.RUNNING:
+            return self.isAbandoned(job, now)
+        return False
+
+    def claim(self, name, fingerprint=None):
+        '''Marks a job as running on this process.
+        fingerprint: identifies the input and the options of the job, a job
+        that is done or failed with another fingerprint is run again
+        Returns True if the job was claimed, False if it is done, running
+        elsewhere, or failed too many times.
+        '''
+        with self.locked():
+            jobs = self.load()
+            now  = time.time()
+            job  = jobs.get(name, {'state'   : JobLedger.PENDING,
+                                   'attempts': 0})
+            if not self.isClaimable(job, now, fingerprint):
+                return False
+            if self.isOutdated(job, fingerprint):
+                sys.stderr.write('[WARNING] job %s was %s with other options or '
+                                 'another input, running it again\n' %
+                                 (name, job['state']))
+                job['attempts'] = 0
+            job['state']       = JobLedger.RUNNING
+            job['attempts']    = job['attempts'] + 1
+            job['fingerprint'] = fingerprint
+            job['host']        = socket.gethostname()
+            job['pid']         = os.getpid()
+            job['started']     = now
+            job['finished']    = None
+            job['elapsed']     = None
+            job['error']       = None
+            jobs[name]         = job
+            self.save(jobs)
+            return True
+
+    def finish(self, name, error=None):
+        '''Marks a job claimed by this process as done, or as failed if an
+        error message is given.
+        '''
+        with self.locked():
+            jobs = self.load()
+            job  = jobs[name]
+            now  = time.time()
+            if error is None:
+                job['state'] = JobLedger.DONE
+            else:
+                job['state'] = JobLedger.FAILED
+            job['finished'] = now
+            job['elapsed']  = now - job['started']
+            job['error']    = error
+            self.save(jobs)
+
+    def summary(self):
+        '''Returns the number of jobs in each state
+        '''
+        with self.locked():
+            jobs = self.load()
+        counts = dict((state, 0) for state in (JobLedger.PENDING,
+                                               JobLedger.RUNNING,
+                                               JobLedger.DONE,
+                                               JobLedger.FAILED))
+        for job in jobs.values():
+            counts[job['state']] += 1
+        return counts
+
+    def states(self, names):
+        '''Returns the state of each of the given jobs, None for the jobs that
+        are not in the ledger
+        '''
+        with self.locked():
+            jobs = self.load()
+        return dict((name, jobs[name]['state'] if name in jobs else None)
+                    for name in names)
+
+    def running(self):
+        '''Returns the names of the running jobs with the host and process
+        running them
+        '''
+        with self.locked():
+            jobs = self.load()
+        return sorted((name, job.get('host'), job.get('pid'))
+                      for name, job in jobs.items()
+                      if job['state'] == JobLedger.RUNNING)
+
+    def run(self, name, function, *args, fingerprint=None):
+        '''Claims a job and runs function(*args) for it, recording the
+        outcome in the ledger. Exceptions are recorded rather than raised so
+        that the remaining jobs of a batch are not lost.
+        Returns True if the job was run successfully.
+        '''
+        if not self.claim(name, fingerprint):
+            return False
+        try:
+            function(*args)
+        except Exception as e:
+            sys.stderr.write('[WARNING] job %s failed: %s\n' % (name, str(e)))
+            self.finish(name, error='%s: %s' % (type(e).__name__, str(e)))
+            return False
+        self.finish(name)
+        return True
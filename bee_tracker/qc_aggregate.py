@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import functools
+
+import numpy
+
+import bee_tracker.table
+
+
+COUNTS      = 'counts'
+PROPORTIONS = 'proportions'
+
+def makeEdges(kind):
+    '''Fixed histogram bin edges, so that histograms computed on different
+    recordings can be merged by adding them.
+    counts: one bin per integer below 64, then geometric bins with a ratio of
+    2^(1/16) (less than 5% relative error) up to 64 * 2^34.
+    proportions: 100 bins over [0, 1].
+    '''
+    if kind == COUNTS:
+        exact     = numpy.arange(0, 65, dtype=float)
+        geometric = 64 * 2 ** (numpy.arange(1, 16 * 34 + 1) / 16)
+        return numpy.concatenate((exact, geometric))
+    if kind == PROPORTIONS:
+        return numpy.linspace(0, 1, 101)
+    raise Exception('Unknown aggregate kind: %s' % kind)
+
+class Aggregate:
+    '''Mergeable summary of the values of a QC statistic, per category.
+    For each category, keeps the number of values, their sum, sum of
+    squares, min, max and a fixed-bin histogram from which quantiles are
+    estimated. The memory used does not depend on the number of values.
+    '''
+
+    SUMMARY_COLUMNS = ['count', 'sum', 'sumSq', 'min', 'max']
+    QUANTILES       = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+    def __init__(self, kind):
+        self.kind       = kind
+        self.edges      = makeEdges(kind)
+        self.summaries  = {}
+        self.histograms = {}
+
+    def getCategory(self, category):
+        if not category in self.summaries:
+            summary                   = numpy.zeros(len(Aggregate.SUMMARY_COLUMNS))
+            summary[3]                = numpy.inf
+            summary[4]                = -numpy.inf
+            self.summaries[category]  = summary
+            self.histograms[category] = numpy.zeros(len(self.edges) - 1, dtype=numpy.int64)
+        return self.summaries[category], self.histograms[category]
+
+    def add(self, categories, values):
+        '''Adds the values, given with their category
+        '''
+        categories = numpy.asarray(categories)
+        values     = numpy.asarray(values, dtype=float)
+        nBins      = len(self.edges) - 1
+        for category in numpy.unique(categories):
+            catValues = values[categories == category]
+            summary, histogram = self.getCategory(category.item())
+            summary[0] += len(catValues)
+            summary[1] += catValues.sum()
+            summary[2] += (catValues * catValues).sum()
+            summary[3]  = min(summary[3], catValues.min())
+            summary[4]  = max(summary[4], catValues.max())
+            bins        = numpy.searchsorted(self.edges, catValues, side='right') - 1
+            bins        = numpy.clip(bins, 0, nBins - 1)
+            histogram  += numpy.bincount(bins, minlength=nBins)
+
+    def merge(self, other):
+        '''Adds the content of another aggregate of the same kind
+        '''
+        if other.kind != self.kind:
+            raise Exception('Cannot merge aggregates of kinds %s and %s' %
+                            (self.kind, other.kind))
+        for category in other.summaries:
+            summary, histogram = self.getCategory(category)
+            otherSummary       = other.summaries[category]
+            summary[:3]       += otherSummary[:3]
+            summary[3]         = min(summary[3], otherSummary[3])
+            summary[4]         = max(summary[4], otherSummary[4])
+            histogram         += other.histograms[category]
+
+    def quantile(self, category, q):
+        '''Estimates a quantile by linear interpolation within the histogram
+        bins
+        '''
+        summary, histogram = self.getCategory(category)
+        cumulative         = numpy.cumsum(histogram)
+        target             = q * cumulative[-1]
+        i                  = numpy.searchsorted(cumulative, target)
+        i                  = min(i, len(histogram) - 1)
+        before             = cumulative[i] - histogram[i]
+        fraction           = 0
+        if histogram[i] > 0:
+            fraction = (target - before) / histogram[i]
+        value = self.edges[i] + fraction * (self.edges[i + 1] - self.edges[i])
+        return min(max(value, summary[3]), summary[4])
+
+    def asDataFrame(self):
+        '''Summary table with one row per category
+        '''
+        import pandas
+        rows = []
+        for category in sorted(self.summaries):
+            count, total, totalSq, low, high = self.summaries[category]
+            mean     = total / count
+            variance = max(totalSq / count - mean * mean, 0)
+            row      = {'category': category,
+                        'count'   : int(count),
+                        'sum'     : total,
+                        'mean'    : mean,
+                        'std'     : numpy.sqrt(variance),
+                        'min'     : low,
+                        'max'     : high}
+            for q in Aggregate.QUANTILES:
+                row['q%02d' % round(q * 100)] = self.quantile(category, q)
+            rows.append(row)
+        return pandas.DataFrame(rows)
+
+    def save(self, path):
+        categories = sorted(self.summaries)
+        numpy.savez(path,
+                    kind=numpy.array(self.kind),
+                    categories=numpy.array(categories),
+                    summaries=numpy.array([self.summaries[x] for x in categories]),
+                    histograms=numpy.array([self.histograms[x] for x in categories]))
+
+def loadAggregate(path):
+    with numpy.load(path) as data:
+        aggregate = Aggregate(str(data['kind']))
+        for i, category in enumerate(data['categories']):
+            summary, histogram = aggregate.getCategory(category.item())
+            summary[:]         = data['summaries'][i]
+            histogram[:]       = data['histograms'][i]
+    return aggregate
+
+class OccupancyGrid:
+    '''Mergeable 2D histogram of the coordinates of the records, per category.
+    The grid covers a fixed extent, xRange by yRange, with cells of a fixed
+    size, so grids computed on different recordings, or on successive chunks
+    of the same recording, can be merged by adding them, and the memory used
+    does not depend on the records. The records outside of the extent, or
+    with coordinates that are not finite, are only counted.
+    '''
+
+    def __init__(self, cellSize=10.0, xRange=(0.0, 4096.0), yRange=(0.0, 4096.0)):
+        self.cellSize = cellSize
+        self.xMin     = float(xRange[0])
+        self.yMin     = float(yRange[0])
+        self.nCols    = max(int(numpy.ceil((xRange[1] - xRange[0]) / cellSize)), 1)
+        self.nRows    = max(int(numpy.ceil((yRange[1] - yRange[0]) / cellSize)), 1)
+        self.grids    = {}
+        self.outside  = 0
+
+    def shape(self):
+        return (self.nRows, self.nCols)
+
+    def geometry(self):
+        return (self.cellSize, self.xMin, self.yMin, self.nRows, self.nCols)
+
+    def getCategory(self, category):
+        if not category in self.grids:
+            self.grids[category] = numpy.zeros(self.shape(), dtype=numpy.int64)
+        return self.grids[category]
+
+    def add(self, categories, xs, ys):
+        '''Adds records given by their category and coordinates. The counts
+        are accumulated in place, so the cost only depends on the number of
+        records added.
+        '''
+        categories = numpy.asarray(categories)
+        with numpy.errstate(invalid='ignore'):
+            cols = numpy.floor((numpy.asarray(xs, dtype=float) - self.xMin) / self.cellSize)
+            rows = numpy.floor((numpy.asarray(ys, dtype=float) - self.yMin) / self.cellSize)
+        inside     = ((cols >= 0) & (cols < self.nCols) &
+                      (rows >= 0) & (rows < self.nRows))
+        self.outside += int(len(inside) - inside.sum())
+        if not inside.any():
+            return
+        cols         = cols[inside].astype(numpy.int64)
+        rows         = rows[inside].astype(numpy.int64)
+        cats, catIdx = numpy.unique(categories[inside], return_inverse=True)
+        for i, category in enumerate(cats):
+            selected = catIdx == i
+            numpy.add.at(self.getCategory(category.item()),
+                         (rows[selected], cols[selected]),
+                         1)
+
+    def merge(self, other):
+        '''Adds the content of another grid with the same cells
+        '''
+        if other.geometry() != self.geometry():
+            raise Exception('Cannot merge grids with different cells: %s and %s' %
+                            (self.geometry(), other.geometry()))
+        for category, grid in other.grids.items():
+            self.getCategory(category)[:] += grid
+        self.outside += other.outside
+
+    def asTable(self):
+        '''Table of the non-empty cells, given by the coordinates of their
+        lower corner
+        '''
+        dfs = []
+        for category in sorted(self.grids):
+            rows, cols = numpy.nonzero(self.grids[category])
+            dfs.append(bee_tracker.table.Table({'category': category,
+                                                'x'       : self.xMin + cols * self.cellSize,
+                                                'y'       : self.yMin + rows * self.cellSize,
+                                                'counts'  : self.grids[category][rows, cols]}))
+        if len(dfs) == 0:
+            return bee_tracker.table.Table()
+        return bee_tracker.table.concat(dfs)
+
+    def save(self, path):
+        '''Saves the grid compressed, most of the cells are usually empty
+        '''
+        categories = sorted(self.grids)
+        numpy.savez_compressed(path,
+                               cellSize=numpy.array(self.cellSize),
+                               origin=numpy.array([self.xMin, self.yMin]),
+                               shape=numpy.array(self.shape()),
+                               outside=numpy.array(self.outside),
+                               categories=numpy.array(categories),
+                               grids=numpy.array([self.grids[x] for x in categories]).reshape((len(categories),) + self.shape()))
+
+def loadOccupancyGrid(path):
+    with numpy.load(path) as data:
+        cellSize     = float(data['cellSize'])
+        xMin, yMin   = data['origin'].tolist()
+        nRows, nCols = data['shape'].tolist()
+        grid         = OccupancyGrid(cellSize,
+                                     (xMin, xMin + nCols * cellSize),
+                                     (yMin, yMin + nRows * cellSize))
+        grid.outside = int(data['outside'])
+        for i, category in enumerate(data['categories']):
+            grid.grids[category.item()] = data['grids'][i].astype(numpy.int64)
+    return grid
+
+def mergeAggregateFiles(paths, load=loadAggregate):
+    '''Merges the aggregates saved in a list of files, holding only one of
+    them in memory at a time. Returns None if the list is empty.
+    '''
+    merged = None
+    for path in paths:
+        aggregate = load(path)
+        if merged is None:
+            merged = aggregate
+        else:
+            merged.merge(aggregate)
+    return merged
+
+def reduceAggregates(paths, pool=None, load=loadAggregate, chunkSize=16):
+    '''Merges the aggregates saved in a list of files, loaded with the load
+    function. With a pool of processes, chunks of chunkSize files are merged
+    in parallel and the partial results are merged as they arrive.
+    '''
+    if pool is None or len(paths) <= chunkSize:
+        return mergeAggregateFiles(paths, load)
+    chunks = [paths[i:i + chunkSize] for i in range(0, len(paths), chunkSize)]
+    merged = None
+    for partial in pool.imap_unordered(functools.partial(mergeAggregateFiles, load=load),
+                                       chunks):
+        if merged is None:
+            merged = partial
+        else:
+            merged.merge(partial)
+    return merged
@@ -9,6 +9,10 @@ import matplotlib.pyplot
 import numpy
 import pandas
 
+import bee_tracker.bee
+import bee_tracker.qc_aggregate
+import bee_tracker.qc_stats
+
 
 class PlotRange:
 
@@ -35,6 +39,7 @@ class QCPlots:
         self.qcStatistic = qcStatistic
         self.directories = directories
         self.outDir      = outDir
+        self.description = qcStatistic.description
         self.htmlPath    = os.path.join(self.outDir,
                                         self.qcStatistic.name + '.html')
 
@@ -51,9 +56,9 @@ class QCPlots:
                 .tableImg {max-width: 100%%;}
             </style>
         </head>
-        <body>\n''' % self.qcStatistic.description
+        <body>\n''' % self.description
         handle.write(header)
-        handle.write('<h1>%s</h1>\n<br/>\n' % self.qcStatistic.description)
+        handle.write('<h1>%s</h1>\n<br/>\n' % self.description)
 
     def writeHTMLFooter(self, handle):
         footer = '''</body>
@@ -71,7 +76,7 @@ class IndexHTML(QCPlots):
         '''Adds a link to an html page with a set of plots
         '''
         href = os.path.basename(qcPlots.htmlPath)
-        txt  = qcPlots.qcStatistic.description
+        txt  = qcPlots.description
         handle.write('<a href="%s">%s</a>\n' % (href, txt))
         handle.write('<br/>\n')
 
@@ -109,7 +114,7 @@ class CountsPerCategoryPlots(QCPlots):
                 self.data[cat].labels.append(label)
                 self.data[cat].dirs.append(folder)
                 if not cat in self.ranges:
-                    self.ranges[cat] = PlotRange(numpy.Inf, 0)
+                    self.ranges[cat] = PlotRange(numpy.inf, 0)
                 self.ranges[cat].updateWithPercentile(data, 1, 99)
                 categories[cat] = 1
         # Categories
@@ -299,18 +304,18 @@ class ClassificationPlots(QCPlots):
         categories               = {}
         self.data                = []
         for directory in self.directories:
-            path   = os.path.join(directory, self.qcStatistic.getOutputFileName())
-            df     = pandas.read_csv(path)
-            cats   = list(df)
-            ### WARNING: strong assumption that column 0 contains the unknown tags
-            for cat in cats:
+            path            = os.path.join(directory, self.qcStatistic.getOutputFileName())
+            tagCounts       = bee_tracker.qc_stats.loadTagCounts(path)
+            tags            = tagCounts.tags
+            for cat in tags:
                 categories[cat] = 1
-            matrix          = df.as_matrix()
+            matrix          = tagCounts.counts.astype(numpy.int64)
             total           = matrix.sum(axis=1)
             if self.minCount > 0:
                 matrix = matrix[total > self.minCount]
                 total  = matrix.sum(axis=1)
-            knownMatrix     = matrix[:,1:]
+            known           = tags != bee_tracker.bee.Bee.UNKNOWN_TAG
+            knownMatrix     = matrix[:, known]
             knownCat        = knownMatrix.argmax(axis=1)
             maxKnown        = knownMatrix[range(len(matrix)), knownCat]
             totalKnown      = knownMatrix.sum(axis=1)
@@ -321,7 +326,7 @@ class ClassificationPlots(QCPlots):
                                                  totalKnown,
                                                  totalKnownProp,
                                                  maxKnownProp,
-                                                 knownCat + 1)
+                                                 tags[known][knownCat])
             self.data.append(data)
         self.categories  = [int(x) for x in categories.keys()]
         self.categories.sort()
@@ -420,3 +425,302 @@ class ClassificationPlots(QCPlots):
             self.plotMaxKnownProp()
             self.writePropTableHTML(handle)
             self.writeHTMLFooter(handle)
+
+class AggregatePlots(QCPlots):
+    '''Plots of a QC statistic aggregated over all the recordings, from the
+    mergeable aggregates saved with each recording
+    '''
+
+    def __init__(self, qcStatistic, directories, outDir, logScale=False, pool=None):
+        QCPlots.__init__(self, qcStatistic, directories, outDir)
+        self.logScale    = logScale
+        self.pool        = pool
+        self.description = qcStatistic.description + ' (all recordings)'
+        self.htmlPath    = os.path.join(self.outDir,
+                                        self.qcStatistic.name + '.aggregate.html')
+        self.csvPath     = os.path.join(self.outDir,
+                                        self.qcStatistic.name + '.aggregate.csv')
+
+    def prepare(self):
+        '''Merges the aggregates of all the recordings
+        '''
+        paths = []
+        for directory in self.directories:
+            path = os.path.join(directory, self.qcStatistic.getAggregateFileName())
+            if os.path.exists(path):
+                paths.append(path)
+        self.aggregate = bee_tracker.qc_aggregate.reduceAggregates(paths, self.pool)
+        self.categories = []
+        if not self.aggregate is None:
+            self.categories = sorted(self.aggregate.summaries)
+
+    def makeHistograms(self):
+        '''Makes a histogram of the merged data for each category
+        '''
+        for cat in self.categories:
+            summary, histogram = self.aggregate.getCategory(cat)
+            edges              = self.aggregate.edges
+            # Only show the range of bins that contain data
+            nonZero            = numpy.flatnonzero(histogram)
+            first              = nonZero[0]
+            last               = nonZero[-1] + 1
+            # Densities rather than counts, as the bins have different widths
+            widths             = numpy.diff(edges[first:last + 1])
+            matplotlib.pyplot.figure()
+            matplotlib.pyplot.bar(edges[first:last],
+                                  histogram[first:last] / widths / summary[0],
+                                  width=widths,
+                                  align='edge')
+            if self.logScale:
+                matplotlib.pyplot.xscale('log')
+                matplotlib.pyplot.yscale('log')
+            matplotlib.pyplot.ylabel('density')
+            img = '%s.aggregate.%d.png' % (self.qcStatistic.name, cat)
+            out = os.path.join(self.outDir, img)
+            matplotlib.pyplot.savefig(out)
+            matplotlib.pyplot.close()
+
+    def writeSummaryHTML(self, handle, df):
+        '''HTML table with the summary statistics of each category
+        '''
+        handle.write('<table>\n')
+        handle.write('  <tr>\n')
+        for column in df.columns:
+            handle.write('    <th>%s</th>\n' % column)
+        handle.write('  </tr>\n')
+        for row in df.itertuples(index=False):
+            handle.write('  <tr>\n')
+            for value in row:
+                handle.write('    <td>%.4g</td>\n' % value)
+            handle.write('  </tr>\n')
+        handle.write('</table>\n')
+
+    def makeHistogramsHTML(self, handle):
+        handle.write('<br/>\n')
+        for cat in self.categories:
+            handle.write('<h2>Category: %d</h2>\n' % cat)
+            img = '%s.aggregate.%d.png' % (self.qcStatistic.name, cat)
+            handle.write('<img src="%s"/>\n' % img)
+        handle.write('<br/>\n')
+
+    def makePlots(self):
+        '''Makes all the plots and the associated HTML
+        '''
+        self.prepare()
+        # Create the output directory if it does not exist
+        if not os.path.exists(self.outDir):
+            os.makedirs(self.outDir)
+        with open(self.htmlPath, "w") as handle:
+            self.writeHTMLHeader(handle)
+            if self.aggregate is None:
+                handle.write('<p>No data</p>\n')
+            else:
+                df = self.aggregate.asDataFrame()
+                df.to_csv(self.csvPath, index=False)
+                self.writeSummaryHTML(handle, df)
+                self.makeHistograms()
+                self.makeHistogramsHTML(handle)
+            self.writeHTMLFooter(handle)
+
+class WindowedPlots(QCPlots):
+    '''Time series of windowed statistics computed from per-frame counts,
+    shown for all the recordings as one heat map per statistic and category
+    '''
+
+    metrics = [('bees',             'Mean number of bees per frame'),
+               ('unknown_fraction', 'Fraction of unknown tags'),
+               ('path_starts',      'Number of path starts'),
+               ('path_ends',        'Number of path ends'),
+               ('gaps',             'Number of gaps')]
+
+    def __init__(self, qcStatistic, directories, outDir, window=100):
+        QCPlots.__init__(self, qcStatistic, directories, outDir)
+        self.window      = window
+        self.description = '%s (windows of %d frames)' % (qcStatistic.description, window)
+
+    def prepare(self):
+        '''Computes the windowed statistics of each recording
+        '''
+        self.data   = {}
+        self.labels = []
+        categories  = {}
+        for directory in self.directories:
+            path  = os.path.join(directory, self.qcStatistic.getOutputFileName())
+            label = os.path.basename(directory).replace('.csv', '')
+            self.labels.append(label)
+            if not os.path.exists(path):
+                continue
+            df = bee_tracker.qc_stats.windowFrameCounts(pandas.read_csv(path), self.window)
+            self.data[label] = df
+            for cat in numpy.unique(df['category']):
+                categories[cat] = 1
+        self.categories = sorted(categories.keys())
+
+    def makeHeatMaps(self):
+        '''One heat map per statistic and category, with one row per
+        recording and one column per window
+        '''
+        for cat in self.categories:
+            series = []
+            for label in self.labels:
+                if label in self.data:
+                    df = self.data[label]
+                    series.append(df.take(df['category'] == cat))
+                else:
+                    series.append(None)
+            nWindows = max(len(x) for x in series if not x is None)
+            for metric, title in WindowedPlots.metrics:
+                matrix = numpy.full((len(series), nWindows), numpy.nan)
+                for i, df in enumerate(series):
+                    if not df is None:
+                        matrix[i, :len(df)] = df[metric]
+                size = (8, 4)
+                if len(self.labels) > 20:
+                    size = (8, len(self.labels) * 0.2)
+                matplotlib.pyplot.figure(figsize=size)
+                matplotlib.pyplot.imshow(matrix,
+                                         aspect='auto',
+                                         interpolation='nearest',
+                                         extent=(0, nWindows * self.window, len(series), 0))
+                cb = matplotlib.pyplot.colorbar()
+                cb.set_label(title)
+                matplotlib.pyplot.yticks(numpy.arange(len(series)) + 0.5, self.labels)
+                matplotlib.pyplot.xlabel('frames since the start of the recording')
+                img = '%s.%s.%d.png' % (self.qcStatistic.name, metric, cat)
+                out = os.path.join(self.outDir, img)
+                matplotlib.pyplot.savefig(out)
+                matplotlib.pyplot.close()
+
+    def makeHeatMapsHTML(self, handle):
+        handle.write('<br/>\n')
+        for metric, title in WindowedPlots.metrics:
+            handle.write('<h2>%s</h2>\n' % title)
+            for cat in self.categories:
+                handle.write('<h3>Category: %d</h3>\n' % cat)
+                img = '%s.%s.%d.png' % (self.qcStatistic.name, metric, cat)
+                handle.write('<img src="%s"/>\n' % img)
+        handle.write('<br/>\n')
+
+    def makePlots(self):
+        '''Makes all the plots and the associated HTML
+        '''
+        self.prepare()
+        # Create the output directory if it does not exist
+        if not os.path.exists(self.outDir):
+            os.makedirs(self.outDir)
+        with open(self.htmlPath, "w") as handle:
+            self.writeHTMLHeader(handle)
+            self.makeHeatMaps()
+            self.makeHeatMapsHTML(handle)
+            self.writeHTMLFooter(handle)
+
+class OccupancyPlots(QCPlots):
+    '''Spatial occupancy heat maps for each recording and for all the
+    recordings together. Only one occupancy grid per recording is held in
+    memory at a time.
+    '''
+
+    def __init__(self, qcStatistic, directories, outDir, pool=None):
+        QCPlots.__init__(self, qcStatistic, directories, outDir)
+        self.pool = pool
+
+    def gridPaths(self):
+        paths = []
+        for directory in self.directories:
+            path = os.path.join(directory, self.qcStatistic.getAggregateFileName())
+            if os.path.exists(path):
+                paths.append(path)
+        return paths
+
+    def plotGrid(self, grid, category, out):
+        # Only the part of the grid that is used is shown
+        counts     = grid.grids[category]
+        rows, cols = numpy.nonzero(counts)
+        if len(rows) == 0:
+            rows = cols = numpy.zeros(1, dtype=int)
+        counts     = counts[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+        xMin       = grid.xMin + cols.min() * grid.cellSize
+        yMin       = grid.yMin + rows.min() * grid.cellSize
+        matplotlib.pyplot.figure()
+        matplotlib.pyplot.imshow(numpy.log10(counts + 1),
+                                 interpolation='nearest',
+                                 extent=(xMin,
+                                         xMin + counts.shape[1] * grid.cellSize,
+                                         yMin + counts.shape[0] * grid.cellSize,
+                                         yMin))
+        cb = matplotlib.pyplot.colorbar()
+        cb.set_label('log10(counts + 1)')
+        matplotlib.pyplot.savefig(out)
+        matplotlib.pyplot.close()
+
+    def makeHeatMaps(self):
+        '''Heat maps of each recording, in its own directory
+        '''
+        categories = {}
+        for path in self.gridPaths():
+            grid   = bee_tracker.qc_aggregate.loadOccupancyGrid(path)
+            folder = os.path.dirname(path)
+            for cat in grid.grids:
+                categories[cat] = 1
+                img = '%s.heatmap.%d.png' % (self.qcStatistic.name, cat)
+                self.plotGrid(grid, cat, os.path.join(folder, img))
+        self.categories = sorted(categories.keys())
+
+    def makeAggregateHeatMaps(self):
+        '''Heat maps of all the recordings merged together
+        '''
+        self.aggregate = bee_tracker.qc_aggregate.reduceAggregates(self.gridPaths(),
+                                                                   self.pool,
+                                                                   bee_tracker.qc_aggregate.loadOccupancyGrid)
+        if self.aggregate is None:
+            return
+        for cat in self.aggregate.grids:
+            img = '%s.heatmap.%d.png' % (self.qcStatistic.name, cat)
+            self.plotGrid(self.aggregate, cat, os.path.join(self.outDir, img))
+
+    def makeHeatMapsHTML(self, handle):
+        '''Aggregated heat maps followed by the table of heat maps of each
+        recording
+        '''
+        handle.write('<h2>All recordings</h2>\n')
+        if not self.aggregate is None:
+            handle.write('<p>%d records outside of the grid</p>\n' % self.aggregate.outside)
+            for cat in sorted(self.aggregate.grids):
+                handle.write('<h3>Category: %d</h3>\n' % cat)
+                img = '%s.heatmap.%d.png' % (self.qcStatistic.name, cat)
+                handle.write('<img src="%s"/>\n' % img)
+        handle.write('<br/>\n')
+        handle.write('<table>\n')
+        handle.write('<tr>\n')
+        handle.write('<th>Category</th>\n')
+        for cat in self.categories:
+            handle.write('<th>%d</th>\n' % cat)
+        handle.write('</tr>\n')
+        for directory in self.directories:
+            handle.write('  <tr>\n')
+            handle.write('    <td>%s</td>\n' % os.path.basename(directory))
+            baseDir = os.path.basename(directory)
+            subDir  = os.path.join(self.outDir, baseDir)
+            for cat in self.categories:
+                img  = '%s.heatmap.%d.png' % (self.qcStatistic.name, cat)
+                path = os.path.join(subDir, img)
+                if os.path.exists(path):
+                    src = os.path.join(baseDir, img)
+                    handle.write('    <td><img src="%s" class="tableImg"/></td>\n' % src)
+                else:
+                    handle.write('    <td>no data</td>\n')
+            handle.write('  </tr>\n')
+        handle.write('</table>\n')
+
+    def makePlots(self):
+        '''Makes all the plots and the associated HTML
+        '''
+        # Create the output directory if it does not exist
+        if not os.path.exists(self.outDir):
+            os.makedirs(self.outDir)
+        with open(self.htmlPath, "w") as handle:
+            self.writeHTMLHeader(handle)
+            self.makeHeatMaps()
+            self.makeAggregateHeatMaps()
+            self.makeHeatMapsHTML(handle)
+            self.writeHTMLFooter(handle)
@@ -3,9 +3,11 @@
 import collections
 import os.path
 
-import pandas
+import numpy
 
 import bee_tracker.bee
+import bee_tracker.qc_aggregate
+import bee_tracker.table
 
 
 class QCStatistic:
@@ -15,6 +17,8 @@ class QCStatistic:
     name        = 'qc_statistic'
     description = 'Bee Tracking QC'
     extension   = '.txt'
+    # Type of histogram used to aggregate the results across recordings
+    aggregateKind = bee_tracker.qc_aggregate.COUNTS
 
     def __init__(self, bees):
         self.bees        = bees
@@ -24,14 +28,36 @@ class QCStatistic:
     def getOutputFileName(cls):
         return cls.name + cls.extension
 
+    @classmethod
+    def getAggregateFileName(cls):
+        return cls.name + '.aggregate.npz'
+
     def compute(self):
         raise Exception('Not implemented')
 
+    def aggregateValues(self):
+        '''Returns the categories and the values that are summarised in the
+        mergeable aggregate
+        '''
+        return self.result['category'], self.result['counts']
+
+    def aggregate(self):
+        '''Returns a mergeable summary of the result
+        '''
+        aggregate = bee_tracker.qc_aggregate.Aggregate(self.aggregateKind)
+        aggregate.add(*self.aggregateValues())
+        return aggregate
+
     def write(self, outDir):
         if not self.result is None and not self.result.empty:
             path = os.path.join(outDir, self.getOutputFileName())
             self.result.to_csv(path, index=False)
 
+    def writeAggregate(self, outDir):
+        if not self.result is None and not self.result.empty:
+            path = os.path.join(outDir, self.getAggregateFileName())
+            self.aggregate().save(path)
+
 class BeesPerFrame(QCStatistic):
 
     name        = 'bees_per_frame'
@@ -52,9 +78,9 @@ class BeesPerFrame(QCStatistic):
         for category in categories:
             counts = {'category': category,
                       'counts'  : list(beeCounts[category].values())}
-            df     = pandas.DataFrame(counts)
+            df     = bee_tracker.table.Table(counts)
             dfs.append(df)
-        self.result = pandas.concat(dfs)
+        self.result = bee_tracker.table.concat(dfs)
 
 class FramesPerBee(QCStatistic):
 
@@ -75,9 +101,9 @@ class FramesPerBee(QCStatistic):
         for category in categories:
             counts = {'category': category,
                       'counts'  : list(frameCounts[category])}
-            df     = pandas.DataFrame(counts)
+            df     = bee_tracker.table.Table(counts)
             dfs.append(df)
-        self.result = pandas.concat(dfs)
+        self.result = bee_tracker.table.concat(dfs)
 
 class FramesPerPath(QCStatistic):
 
@@ -101,9 +127,9 @@ class FramesPerPath(QCStatistic):
         for category in categories:
             counts = {'category': category,
                       'counts'  : list(frameCounts[category])}
-            df     = pandas.DataFrame(counts)
+            df     = bee_tracker.table.Table(counts)
             dfs.append(df)
-        self.result = pandas.concat(dfs)
+        self.result = bee_tracker.table.concat(dfs)
 
 class FramesBetweenPaths(QCStatistic):
 
@@ -125,9 +151,9 @@ class FramesBetweenPaths(QCStatistic):
         for category in categories:
             counts = {'category': category,
                       'counts'  : list(frameCounts[category])}
-            df     = pandas.DataFrame(counts)
+            df     = bee_tracker.table.Table(counts)
             dfs.append(df)
-        self.result = pandas.concat(dfs)
+        self.result = bee_tracker.table.concat(dfs)
 
 class PathsPerBee(QCStatistic):
 
@@ -147,39 +173,209 @@ class PathsPerBee(QCStatistic):
         for category in categories:
             counts = {'category': category,
                       'counts'  : list(pathCounts[category])}
-            df     = pandas.DataFrame(counts)
+            df     = bee_tracker.table.Table(counts)
             dfs.append(df)
-        self.result = pandas.concat(dfs)
+        self.result = bee_tracker.table.concat(dfs)
+
+class TagCounts:
+    '''Number of records of each tag for each bee, as a matrix of the
+    narrowest unsigned integer type that holds the counts, with one row per
+    bee and one column per tag. The unknown tag always has a column.
+    '''
+
+    def __init__(self, beeIds, tags, counts):
+        self.beeIds = beeIds
+        self.tags   = tags
+        self.counts = counts
+
+    @property
+    def empty(self):
+        return len(self.beeIds) == 0
+
+    def save(self, path):
+        numpy.savez_compressed(path,
+                               beeIds=self.beeIds,
+                               tags=self.tags,
+                               counts=self.counts)
+
+def loadTagCounts(path):
+    with numpy.load(path) as data:
+        return TagCounts(data['beeIds'], data['tags'], data['counts'])
 
 class Classification(QCStatistic):
 
     name        = 'classification'
     description = 'Tag classification'
+    extension   = '.npz'
+    # The aggregate summarises the tag consistency of each bee: the
+    # proportion of its known tags that are of its main known tag
+    aggregateKind = bee_tracker.qc_aggregate.PROPORTIONS
 
     def __init__(self, bees):
         QCStatistic.__init__(self, bees)
 
     def compute(self):
-        # Deal with arbitrary number of categories
-        tags = {}
-        for bee in self.bees.values():
-            for tag in bee.tags:
-                if not tag in tags:
-                    tags[tag] = 1
-        classifications = {}
-        for tag in tags:
-            classifications[tag] = []
-        idx = 0
+        # One bincount over a combined (bee, tag) key, for any number of tags
+        bees    = list(self.bees.values())
+        beeIds  = numpy.array([x.beeId for x in bees])
+        lengths = [len(x.tags) for x in bees]
+        allTags = numpy.concatenate([numpy.asarray(x.tags) for x in bees] +
+                                    [[bee_tracker.bee.Bee.UNKNOWN_TAG]])
+        tags, tagIdx = numpy.unique(allTags, return_inverse=True)
+        # Drop the unknown tag added to make sure it has a column
+        tagIdx  = tagIdx[:-1]
+        beeIdx  = numpy.repeat(numpy.arange(len(bees)), lengths)
+        counts  = numpy.bincount(beeIdx * len(tags) + tagIdx,
+                                 minlength=len(bees) * len(tags))
+        counts  = counts.reshape(len(bees), len(tags))
+        dtype   = numpy.min_scalar_type(counts.max() if counts.size > 0 else 0)
+        self.result = TagCounts(beeIds, tags, counts.astype(dtype))
+
+    def write(self, outDir):
+        if not self.result is None and not self.result.empty:
+            path = os.path.join(outDir, self.getOutputFileName())
+            self.result.save(path)
+
+    def aggregateValues(self):
+        tags        = self.result.tags
+        known       = tags != bee_tracker.bee.Bee.UNKNOWN_TAG
+        knownMatrix = self.result.counts[:, known]
+        totalKnown  = knownMatrix.sum(axis=1)
+        where       = totalKnown > 0
+        knownMatrix = knownMatrix[where]
+        if knownMatrix.size == 0:
+            return numpy.array([], dtype=int), numpy.array([])
+        knownCat    = knownMatrix.argmax(axis=1)
+        maxKnown    = knownMatrix[numpy.arange(len(knownMatrix)), knownCat]
+        return tags[known][knownCat], maxKnown / totalKnown[where]
+
+class FrameCounts(QCStatistic):
+    '''Counts of records, unknown tags, path starts, path ends and gaps for
+    each frame and category, from which any windowed statistic can be
+    derived, see windowFrameCounts.
+    '''
+
+    name        = 'frame_counts'
+    description = 'Counts per frame'
+    columns     = ['bees', 'unknown', 'path_starts', 'path_ends', 'gaps']
+
+    def __init__(self, bees):
+        QCStatistic.__init__(self, bees)
+
+    def compute(self):
+        # Frames of each type of event, per category
+        events = collections.defaultdict(lambda: collections.defaultdict(list))
         for bee in self.bees.values():
-            for tag in tags:
-                classifications[tag].append(0)
-            for tag in bee.tags:
-                classifications[tag][idx] += 1
-            idx += 1
-        self.result = pandas.DataFrame(classifications)
+            frames = numpy.asarray(bee.frames)
+            tags   = numpy.asarray(bee.tags)
+            starts = numpy.asarray(bee.pathStarts)
+            ends   = numpy.append(starts[1:], len(frames)) - 1
+            catEvents = events[bee.category]
+            catEvents['bees'].append(frames)
+            catEvents['unknown'].append(frames[tags == bee_tracker.bee.Bee.UNKNOWN_TAG])
+            catEvents['path_starts'].append(frames[starts])
+            catEvents['path_ends'].append(frames[ends])
+            catEvents['gaps'].append(frames[starts[1:]])
+        if len(events) == 0:
+            return
+        first   = min(min(y.min() for y in x['bees']) for x in events.values())
+        last    = max(max(y.max() for y in x['bees']) for x in events.values())
+        nFrames = last - first + 1
+        dfs     = []
+        for category in sorted(events):
+            counts = {'frame'   : numpy.arange(first, last + 1),
+                      'category': category}
+            for column in FrameCounts.columns:
+                frames         = numpy.concatenate(events[category][column])
+                counts[column] = numpy.bincount(frames - first, minlength=nFrames)
+            dfs.append(bee_tracker.table.Table(counts))
+        self.result = bee_tracker.table.concat(dfs)
+
+    def writeAggregate(self, outDir):
+        # The counts are only plotted as time series, see WindowedPlots, they
+        # are not aggregated across recordings
+        pass
+
+class Occupancy(QCStatistic):
+    '''Number of records in each cell of a spatial grid, per category.
+    The result lists the non-empty cells, the grid itself is saved as the
+    mergeable aggregate. The grid covers xRange by yRange, the default ones
+    if None, and only counts the records outside of them.
+    '''
+
+    name        = 'occupancy'
+    description = 'Spatial occupancy'
+    cellSize    = 10.0
+    xRange      = (0.0, 4096.0)
+    yRange      = (0.0, 4096.0)
+
+    def __init__(self, bees, xRange=None, yRange=None):
+        QCStatistic.__init__(self, bees)
+        self.grid = None
+        if not xRange is None:
+            self.xRange = tuple(xRange)
+        if not yRange is None:
+            self.yRange = tuple(yRange)
+
+    def compute(self):
+        self.grid = bee_tracker.qc_aggregate.OccupancyGrid(self.cellSize,
+                                                           self.xRange,
+                                                           self.yRange)
+        if len(self.bees) == 0:
+            return
+        bees       = list(self.bees.values())
+        categories = numpy.repeat([x.category for x in bees],
+                                  [len(x.frames) for x in bees])
+        xs         = numpy.concatenate([x.xs for x in bees])
+        ys         = numpy.concatenate([x.ys for x in bees])
+        self.grid.add(categories, xs, ys)
+        self.result = self.grid.asTable()
+
+    def aggregate(self):
+        return self.grid
+
+def windowSums(counts, window):
+    '''Sums of counts over consecutive windows of a given size, computed from
+    their cumulative sum. The last window may be incomplete.
+    '''
+    cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+    bounds     = numpy.append(numpy.arange(0, len(counts), window), len(counts))
+    return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+def windowFrameCounts(df, window):
+    '''Windowed statistics from the result of FrameCounts, given as a Table
+    or a pandas DataFrame: mean number of bees per frame, fraction of unknown
+    tags, and number of path starts, path ends and gaps in each window of a
+    given number of frames. The last window of a recording, or its only
+    window if the recording is shorter than a window, is kept even if it is
+    incomplete: its mean number of bees is over the frames it covers.
+    '''
+    categories = numpy.asarray(df['category'])
+    allFrames  = numpy.asarray(df['frame'])
+    dfs        = []
+    for category in numpy.unique(categories):
+        rows     = numpy.flatnonzero(categories == category)
+        rows     = rows[numpy.argsort(allFrames[rows], kind='stable')]
+        frames   = allFrames[rows]
+        sums     = {}
+        for column in FrameCounts.columns:
+            sums[column] = windowSums(numpy.asarray(df[column])[rows], window)
+        bees     = sums['bees']
+        nonZero  = numpy.maximum(bees, 1)
+        lengths  = windowSums(numpy.ones(len(frames), dtype=int), window)
+        windowed = {'frame'           : frames[::window],
+                    'category'        : category,
+                    'bees'            : bees / lengths,
+                    'unknown_fraction': numpy.where(bees > 0, sums['unknown'] / nonZero, numpy.nan),
+                    'path_starts'     : sums['path_starts'],
+                    'path_ends'       : sums['path_ends'],
+                    'gaps'            : sums['gaps']}
+        dfs.append(bee_tracker.table.Table(windowed))
+    return bee_tracker.table.concat(dfs)
 
 def computeStats(stats, bees, outDir):
     for stat in stats:
         instance = stat(bees)
         instance.compute()
         instance.write(outDir)
+        instance.writeAggregate(outDir)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+import numpy
+
+import bee_tracker.bee
+
+
+class Recording:
+    '''Columnar representation of a recording.
+    The records are held as a few NumPy arrays sorted by (BeeID, Frame), see
+    io_csv.normalizeDataFrame, together with the boundaries of the bees and of
+    their paths, so that filters can be evaluated as boolean masks over the
+    whole recording at once.
+    '''
+
+    def __init__(self, df):
+        self.ids    = numpy.asarray(df['BeeID'])
+        self.tags   = numpy.asarray(df['Tag'])
+        self.frames = numpy.asarray(df['Frame'])
+        self.xs     = numpy.asarray(df['X'])
+        self.ys     = numpy.asarray(df['Y'])
+        nRecords    = len(self.ids)
+        # A new bee starts whenever the id changes, a new path whenever the
+        # bee changes or a frame is skipped
+        newBee      = numpy.ones(nRecords, dtype=bool)
+        newBee[1:]  = self.ids[1:] != self.ids[:-1]
+        newPath     = newBee.copy()
+        newPath[1:] |= self.frames[1:] != self.frames[:-1] + 1
+        self.beeStarts  = numpy.flatnonzero(newBee)
+        self.beeEnds    = numpy.append(self.beeStarts[1:], nRecords)
+        self.beeIds     = self.ids[self.beeStarts]
+        self.rowBee     = numpy.cumsum(newBee) - 1
+        self.pathStarts = numpy.flatnonzero(newPath)
+        self.pathEnds   = numpy.append(self.pathStarts[1:], nRecords)
+        self.rowPath    = numpy.cumsum(newPath) - 1
+        self.categories = numpy.zeros(len(self.beeStarts), dtype=self.tags.dtype)
+        self.categories[:] = bee_tracker.bee.Bee.UNKNOWN_TAG
+
+    def __len__(self):
+        return len(self.ids)
+
+    def beeSizes(self):
+        return self.beeEnds - self.beeStarts
+
+    def pathSizes(self):
+        return self.pathEnds - self.pathStarts
+
+    def classify(self, minCount=100, consistency=0.7):
+        '''Classifies all the bees at once, with the same rules as
+        Bee.classify. Ties between the most frequent tags go to the smallest
+        tag, where Bee.classify keeps the first one seen, so the categories
+        can only differ when consistency is 0.5 or less.
+        '''
+        nBees = len(self.beeStarts)
+        if nBees == 0:
+            return
+        tagValues, tagIdx = numpy.unique(self.tags, return_inverse=True)
+        nTags  = len(tagValues)
+        counts = numpy.bincount(self.rowBee * nTags + tagIdx,
+                                minlength=nBees * nTags).reshape(nBees, nTags)
+        counts[:, tagValues == bee_tracker.bee.Bee.UNKNOWN_TAG] = 0
+        maxIdx     = counts.argmax(axis=1)
+        maxCount   = counts[numpy.arange(nBees), maxIdx]
+        totalCount = counts.sum(axis=1)
+        classified = (maxCount > minCount) & (maxCount >= consistency * totalCount)
+        self.categories[:]          = bee_tracker.bee.Bee.UNKNOWN_TAG
+        self.categories[classified] = tagValues[maxIdx[classified]]
+
+    def select(self, *filters):
+        '''Returns a view of the records that pass all the filters
+        '''
+        return RecordingView(self).where(*filters)
+
+class RecordingView:
+    '''A subset of a recording, defined by a mask over its records.
+    The data of the recording is not copied.
+    '''
+
+    def __init__(self, recording, rowMask=None):
+        self.recording = recording
+        if rowMask is None:
+            rowMask = numpy.ones(len(recording), dtype=bool)
+        self.rowMask   = rowMask
+
+    def __len__(self):
+        return int(self.rowMask.sum())
+
+    def where(self, *filters):
+        '''Returns a new view restricted to the records that pass all the
+        filters. The filters are all evaluated on the full recording, so that
+        the order in which they are given does not matter.
+        '''
+        rowMask = self.rowMask.copy()
+        for f in filters:
+            rowMask &= f.rowMask(self.recording)
+        return RecordingView(self.recording, rowMask)
+
+    def bees(self):
+        '''Creates a dictionary of bee objects indexed by bee id from the
+        records of the view. The arrays of bees that are not cut by the
+        filters are views of the arrays of the recording.
+        '''
+        rec   = self.recording
+        bees  = {}
+        if len(rec) == 0:
+            return bees
+        kept  = numpy.add.reduceat(self.rowMask.astype(numpy.int64), rec.beeStarts)
+        sizes = rec.beeSizes()
+        for i in numpy.flatnonzero(kept):
+            start = rec.beeStarts[i]
+            end   = rec.beeEnds[i]
+            if kept[i] == sizes[i]:
+                rows = slice(start, end)
+            else:
+                rows = start + numpy.flatnonzero(self.rowMask[start:end])
+            bee             = bee_tracker.bee.Bee(rec.beeIds[i])
+            bee.tags        = rec.tags[rows]
+            bee.frames      = rec.frames[rows]
+            bee.xs          = rec.xs[rows]
+            bee.ys          = rec.ys[rows]
+            bee.category    = rec.categories[i]
+            bee.findPathStarts()
+            bees[bee.beeId] = bee
+        return bees
+
+class RecordingFilter:
+    '''Parent class of the filters.
+    A filter computes a mask over the bees, the paths or the records of a
+    recording, depending on its level, which is then broadcast to the records.
+    '''
+
+    BEE  = 'bee'
+    PATH = 'path'
+    ROW  = 'row'
+
+    level       = ROW
+    description = 'filter'
+
+    def mask(self, recording):
+        raise Exception('Not implemented')
+
+    def rowMask(self, recording):
+        mask = self.mask(recording)
+        if self.level == RecordingFilter.BEE:
+            return mask[recording.rowBee]
+        if self.level == RecordingFilter.PATH:
+            return mask[recording.rowPath]
+        return mask
+
+class MinBeeSize(RecordingFilter):
+    '''Keeps the bees with at least minSize records
+    '''
+
+    level       = RecordingFilter.BEE
+    description = 'minimum bee size'
+
+    def __init__(self, minSize):
+        self.minSize = minSize
+
+    def mask(self, recording):
+        return recording.beeSizes() >= self.minSize
+
+class MinPathSize(RecordingFilter):
+    '''Keeps the paths with at least minSize records
+    '''
+
+    level       = RecordingFilter.PATH
+    description = 'minimum path size'
+
+    def __init__(self, minSize):
+        self.minSize = minSize
+
+    def mask(self, recording):
+        return recording.pathSizes() >= self.minSize
+
+class Categories(RecordingFilter):
+    '''Keeps the bees classified in one of the given categories
+    '''
+
+    level       = RecordingFilter.BEE
+    description = 'categories'
+
+    def __init__(self, categories):
+        self.categories = list(categories)
+
+    def mask(self, recording):
+        return numpy.isin(recording.categories, self.categories)
+
+class FrameWindow(RecordingFilter):
+    '''Keeps the records with first <= frame <= last
+    '''
+
+    level       = RecordingFilter.ROW
+    description = 'frame window'
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last  = last
+
+    def mask(self, recording):
+        return (recording.frames >= self.first) & (recording.frames <= self.last)
+
+class Region(RecordingFilter):
+    '''Keeps the records within a rectangular region
+    '''
+
+    level       = RecordingFilter.ROW
+    description = 'region'
+
+    def __init__(self, xMin, xMax, yMin, yMax):
+        self.xMin = xMin
+        self.xMax = xMax
+        self.yMin = yMin
+        self.yMax = yMax
+
+    def mask(self, recording):
+        xs = recording.xs
+        ys = recording.ys
+        return (xs >= self.xMin) & (xs <= self.xMax) & (ys >= self.yMin) & (ys <= self.yMax)
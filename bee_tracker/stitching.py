@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import collections
+
+import numpy
+
+import bee_tracker.bee
+import bee_tracker.io_csv
+import bee_tracker.table
+
+
+class EndpointIndex:
+    '''Spatio-temporal grid index over the first records of the bees.
+    Buckets are maxGap frames long and maxDistance wide, so all the starts
+    within maxGap frames and maxDistance of a point are found in at most
+    2 x 3 x 3 buckets.
+    '''
+
+    def __init__(self, frames, xs, ys, maxDistance, maxGap):
+        self.maxDistance = maxDistance
+        self.maxGap      = maxGap
+        self.buckets     = collections.defaultdict(list)
+        keys             = zip((frames // maxGap).tolist(),
+                               numpy.floor(xs / maxDistance).astype(int).tolist(),
+                               numpy.floor(ys / maxDistance).astype(int).tolist())
+        for i, key in enumerate(keys):
+            self.buckets[key].append(i)
+
+    def query(self, frame, x, y):
+        '''Returns the candidate starts around a point, after the given frame
+        '''
+        cellX = int(numpy.floor(x / self.maxDistance))
+        cellY = int(numpy.floor(y / self.maxDistance))
+        first = (frame + 1) // self.maxGap
+        last  = (frame + self.maxGap) // self.maxGap
+        found = []
+        for bucket in range(first, last + 1):
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    found.extend(self.buckets.get((bucket, cellX + dx, cellY + dy), ()))
+        return found
+
+def findJoins(recording, maxDistance=20.0, maxGap=10, sameCategory=True):
+    '''Finds the pairs of bees where one ends and the other starts within
+    maxGap frames and maxDistance, as produced by tracker id switches.
+    With sameCategory, bees classified in different known categories are
+    not joined. Each bee is joined at most once as the end and once as the
+    start of a pair, the closest candidates in time then in space first.
+    Bees whose first or last record has non-finite coordinates can not be
+    located and are never joined at that end.
+    Returns a table of the joins.
+    '''
+    if maxGap < 1:
+        raise Exception('The maximum gap must be at least one frame: %s' % maxGap)
+    if maxDistance <= 0:
+        raise Exception('The maximum distance must be positive: %s' % maxDistance)
+    rec       = recording
+    starts    = rec.beeStarts
+    ends      = rec.beeEnds - 1
+    # Indices of the bees whose start, resp. end, can be located
+    startable = numpy.flatnonzero(numpy.isfinite(rec.xs[starts]) & numpy.isfinite(rec.ys[starts]))
+    endable   = numpy.flatnonzero(numpy.isfinite(rec.xs[ends]) & numpy.isfinite(rec.ys[ends]))
+    index     = EndpointIndex(rec.frames[starts[startable]],
+                              rec.xs[starts[startable]],
+                              rec.ys[starts[startable]],
+                              maxDistance,
+                              maxGap)
+    unknown   = bee_tracker.bee.Bee.UNKNOWN_TAG
+    endBees   = []
+    startBees = []
+    for i in endable.tolist():
+        candidates = index.query(rec.frames[ends[i]], rec.xs[ends[i]], rec.ys[ends[i]])
+        endBees.extend([i] * len(candidates))
+        startBees.extend(candidates)
+    endBees   = numpy.array(endBees, dtype=int)
+    # The index returns positions in the list of locatable starts
+    startBees = startable[numpy.array(startBees, dtype=int)]
+    # Exact distance, frame gap and tag consistency tests on all the
+    # candidates at once
+    endRows   = ends[endBees]
+    startRows = starts[startBees]
+    gaps      = rec.frames[startRows] - rec.frames[endRows]
+    distances = numpy.hypot(rec.xs[startRows] - rec.xs[endRows],
+                            rec.ys[startRows] - rec.ys[endRows])
+    valid     = (startBees != endBees) & (gaps > 0) & (gaps <= maxGap) & (distances <= maxDistance)
+    if sameCategory:
+        endCats   = rec.categories[endBees]
+        startCats = rec.categories[startBees]
+        valid    &= (endCats == startCats) | (endCats == unknown) | (startCats == unknown)
+    endBees   = endBees[valid]
+    startBees = startBees[valid]
+    gaps      = gaps[valid]
+    distances = distances[valid]
+    # Greedy one to one matching
+    order     = numpy.lexsort((distances, gaps))
+    usedEnds   = numpy.zeros(len(ends), dtype=bool)
+    usedStarts = numpy.zeros(len(starts), dtype=bool)
+    selected   = []
+    for i in order:
+        if not usedEnds[endBees[i]] and not usedStarts[startBees[i]]:
+            usedEnds[endBees[i]]     = True
+            usedStarts[startBees[i]] = True
+            selected.append(i)
+    selected = numpy.array(selected, dtype=int)
+    return bee_tracker.table.Table({'EndID'   : rec.beeIds[endBees[selected]],
+                                    'StartID' : rec.beeIds[startBees[selected]],
+                                    'Gap'     : gaps[selected],
+                                    'Distance': distances[selected]})
+
+def remapIds(recording, joins):
+    '''Follows the chains of joins to map every bee id to the id of the first
+    bee of its chain. Returns a table with the old and new ids, sorted by old
+    id.
+    '''
+    parent = dict(zip(numpy.asarray(joins['StartID']).tolist(),
+                      numpy.asarray(joins['EndID']).tolist()))
+    newIds = []
+    for beeId in recording.beeIds.tolist():
+        root = beeId
+        # Joins always go forward in time, so chains have no cycles
+        while root in parent:
+            root = parent[root]
+        newIds.append(root)
+    return bee_tracker.table.Table({'BeeID'     : recording.beeIds,
+                                    'StitchedID': newIds})
+
+def applyStitching(df, table):
+    '''Replaces the ids of the records by their stitched ids and restores the
+    (BeeID, Frame) order. Returns the new data frame and its validation
+    report.
+    '''
+    rows        = numpy.searchsorted(table['BeeID'], numpy.asarray(df['BeeID']))
+    df          = df.copy()
+    df['BeeID'] = table['StitchedID'][rows]
+    return bee_tracker.io_csv.normalizeDataFrame(df)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import numpy
+
+
+class Table:
+    '''Minimal column store: named NumPy arrays of the same length.
+    It covers what the statistics need from a pandas DataFrame (column
+    access, row selection, CSV output) so that computing them does not
+    require importing pandas.
+    '''
+
+    def __init__(self, columns=None):
+        '''columns: dictionary of column names to sequences. Scalars are
+        repeated to the length of the other columns.
+        '''
+        self.data = {}
+        if columns is None:
+            return
+        lengths = [len(x) for x in columns.values() if not numpy.isscalar(x)]
+        nRows   = lengths[0] if len(lengths) > 0 else 1
+        for name, values in columns.items():
+            if numpy.isscalar(values):
+                self.data[name] = numpy.full(nRows, values)
+            else:
+                self.data[name] = numpy.asarray(values)
+
+    @property
+    def columns(self):
+        return list(self.data.keys())
+
+    @property
+    def empty(self):
+        return len(self.data) == 0 or len(self) == 0
+
+    def __len__(self):
+        if len(self.data) == 0:
+            return 0
+        return len(next(iter(self.data.values())))
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __setitem__(self, name, values):
+        self.data[name] = numpy.asarray(values)
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def take(self, rows):
+        '''Returns a new table with the rows selected by an index array or a
+        boolean mask
+        '''
+        table = Table()
+        for name, values in self.data.items():
+            table.data[name] = values[rows]
+        return table
+
+    def copy(self):
+        table = Table()
+        for name, values in self.data.items():
+            table.data[name] = values.copy()
+        return table
+
+    def matrix(self):
+        '''The columns stacked in a 2D array
+        '''
+        return numpy.column_stack([self.data[x] for x in self.columns])
+
+    def to_csv(self, path, index=False):
+        '''Writes the table as CSV, in the same format as
+        pandas.DataFrame.to_csv(path, index=False)
+        '''
+        columns = [self.data[x].astype(str) for x in self.columns]
+        with open(path, 'w') as handle:
+            handle.write(','.join(str(x) for x in self.columns) + '\n')
+            for row in zip(*columns):
+                handle.write(','.join(row) + '\n')
+
+def concat(tables):
+    '''Concatenates tables with the same columns
+    '''
+    table = Table()
+    if len(tables) == 0:
+        return table
+    for name in tables[0].columns:
+        table.data[name] = numpy.concatenate([x[name] for x in tables])
+    return table
+
+def takeRows(data, rows):
+    '''Selects rows of a Table or of a pandas DataFrame
+    '''
+    if isinstance(data, Table):
+        return data.take(rows)
+    return data.iloc[rows]
+
+# Values read as NaN, the default NA values of pandas.read_csv
+NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN',
+                       '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+                       'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+def parseFloat(text):
+    text = text.strip()
+    if text in NA_VALUES:
+        return numpy.nan
+    return float(text)
+
+def readCSV(path, dtype):
+    '''Loads a CSV file with NumPy only. Lines starting with # are ignored,
+    the first other line is the header. dtype maps the column names to their
+    types, the other columns are read as floats.
+    Empty fields and the NA values of pandas are read as NaN in the float
+    columns; they raise a ValueError in the integer columns, as with pandas.
+    '''
+    with open(path) as handle:
+        names = None
+        for nLines, line in enumerate(handle, 1):
+            line = line.split('#')[0].strip()
+            if line:
+                names = [x.strip() for x in line.split(',')]
+                break
+        if names is None:
+            return Table()
+        types = [(x, dtype.get(x, float)) for x in names]
+        try:
+            data = numpy.loadtxt(handle,
+                                 delimiter=',',
+                                 comments='#',
+                                 dtype=types,
+                                 ndmin=1)
+        except ValueError:
+            # Missing values are rare, only convert the float fields one by
+            # one when the fast path fails
+            handle.seek(0)
+            converters = dict((i, parseFloat) for i, (x, t) in enumerate(types)
+                              if numpy.dtype(t).kind == 'f')
+            data = numpy.loadtxt(handle,
+                                 delimiter=',',
+                                 comments='#',
+                                 dtype=types,
+                                 converters=converters,
+                                 skiprows=nLines,
+                                 ndmin=1)
+    table = Table()
+    for name in names:
+        table.data[name] = numpy.ascontiguousarray(data[name])
+    return table
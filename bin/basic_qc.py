@@ -1,40 +1,117 @@
 #!/usr/bin/python
 
 import argparse
+import functools
+import hashlib
+import json
 import multiprocessing
 import os.path
 import sys
 
-import matplotlib
-matplotlib.use('Agg')
-import pandas
-
+# Only the modules needed to compute the statistics are imported here, pandas
+# and matplotlib are only imported when they are needed
 import bee_tracker.io_csv
-import bee_tracker.qc_plot
+import bee_tracker.job_ledger
 import bee_tracker.qc_stats
+import bee_tracker.recording
+import bee_tracker.stitching
 
 
 class StatsWorker:
 
+    # Options that change the computed statistics
+    computeOptions = ['keepDuplicates', 'xRange', 'yRange', 'knownTags',
+                      'dropBadCoords', 'minBeeSize', 'minPathSize',
+                      'categories', 'frames', 'region', 'stitch',
+                      'stitchDistance', 'stitchGap']
+
     def __init__(self, args):
         self.args = args
 
+    def fingerprint(self, path):
+        '''Identifies the input file and the options a recording is computed
+        with, so that the ledger does not skip it when either changed
+        '''
+        stat    = os.stat(path)
+        content = {'input'  : os.path.abspath(path),
+                   'mtime'  : stat.st_mtime_ns,
+                   'size'   : stat.st_size,
+                   'options': dict((x, getattr(self.args, x)) for x in StatsWorker.computeOptions)}
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
     def work(self, path):
+        '''Processes a recording unless the ledger says it is done or claimed
+        by another process
+        '''
+        name = os.path.basename(path)
+        if self.args.noLedger:
+            self.compute(path)
+            return True
+        ledger = bee_tracker.job_ledger.JobLedger(self.args.outDir,
+                                                  maxAttempts=self.args.maxAttempts,
+                                                  staleAfter=self.args.staleAfter)
+        return ledger.run(name, self.compute, path, fingerprint=self.fingerprint(path))
+
+    def compute(self, path):
         stats  = [bee_tracker.qc_stats.BeesPerFrame,
                   bee_tracker.qc_stats.FramesPerBee,
                   bee_tracker.qc_stats.FramesPerPath,
                   bee_tracker.qc_stats.FramesBetweenPaths,
                   bee_tracker.qc_stats.PathsPerBee,
-                  bee_tracker.qc_stats.Classification]
+                  bee_tracker.qc_stats.Classification,
+                  bee_tracker.qc_stats.FrameCounts,
+                  functools.partial(bee_tracker.qc_stats.Occupancy,
+                                    xRange=self.args.xRange,
+                                    yRange=self.args.yRange)]
         name   = os.path.basename(path)
-        outDir = os.path.join(args.outDir, name)
+        outDir = os.path.join(self.args.outDir, name)
         if not os.path.exists(outDir):
             os.makedirs(outDir)
-        bees  = bee_tracker.io_csv.loadBeesCSV(path)
-        for bee in bees.values():
-            bee.classify()
+        df     = bee_tracker.io_csv.loadCSVTable(path,
+                                                     threads=self.args.threads,
+                                                     engine=self.args.engine)
+        df, report = bee_tracker.io_csv.normalizeDataFrame(df,
+                                                           dropDuplicates=not self.args.keepDuplicates,
+                                                           xRange=self.args.xRange,
+                                                           yRange=self.args.yRange,
+                                                           knownTags=self.args.knownTags,
+                                                           dropBadCoords=self.args.dropBadCoords)
+        report.write(outDir)
+        sys.stderr.write('%s: %s\n' % (name, report))
+        recording = bee_tracker.recording.Recording(df)
+        recording.classify()
+        if self.args.stitch:
+            joins = bee_tracker.stitching.findJoins(recording,
+                                                    maxDistance=self.args.stitchDistance,
+                                                    maxGap=self.args.stitchGap)
+            table = bee_tracker.stitching.remapIds(recording, joins)
+            table.to_csv(os.path.join(outDir, 'stitching.csv'), index=False)
+            sys.stderr.write('%s: %d bees stitched\n' % (name, len(joins)))
+            df, report = bee_tracker.stitching.applyStitching(df, table)
+            recording  = bee_tracker.recording.Recording(df)
+            recording.classify()
+        elif os.path.exists(os.path.join(outDir, 'stitching.csv')):
+            # Left by a previous run with other options
+            os.remove(os.path.join(outDir, 'stitching.csv'))
+        bees      = recording.select(*self.filters()).bees()
         bee_tracker.qc_stats.computeStats(stats, bees, outDir)
 
+    def filters(self):
+        '''The filters selected on the command line
+        '''
+        filters = []
+        if self.args.minBeeSize > 0:
+            filters.append(bee_tracker.recording.MinBeeSize(self.args.minBeeSize))
+        if self.args.minPathSize > 0:
+            filters.append(bee_tracker.recording.MinPathSize(self.args.minPathSize))
+        if not self.args.categories is None:
+            filters.append(bee_tracker.recording.Categories(self.args.categories))
+        if not self.args.frames is None:
+            filters.append(bee_tracker.recording.FrameWindow(*self.args.frames))
+        if not self.args.region is None:
+            filters.append(bee_tracker.recording.Region(*self.args.region))
+        return filters
+
 def parseArgs():
     parser = argparse.ArgumentParser(description='Compute basic QC stats for bee movie')
     parser.add_argument('input',
@@ -52,6 +129,17 @@ def parseArgs():
                         default=0,
                         metavar='N',
                         help='Number of parallel processes')
+    parser.add_argument('-t',
+                        '--threads',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Number of threads parsing each input file')
+    parser.add_argument('-e',
+                        '--engine',
+                        choices=['auto', 'numpy', 'pandas'],
+                        default='auto',
+                        help='Library used to parse the input files')
     parser.add_argument('-r',
                         '--profile',
                         action='store_true',
@@ -64,22 +152,160 @@ def parseArgs():
                         '--noData',
                         action='store_true',
                         help='Dont compute the data, only plot')
+    parser.add_argument('--keepDuplicates',
+                        action='store_true',
+                        help='Do not drop the duplicated (BeeID, Frame) records')
+    parser.add_argument('--xRange',
+                        type=float,
+                        nargs=2,
+                        default=None,
+                        metavar=('MIN', 'MAX'),
+                        help='Valid range of the X coordinates, also the extent of the occupancy grid')
+    parser.add_argument('--yRange',
+                        type=float,
+                        nargs=2,
+                        default=None,
+                        metavar=('MIN', 'MAX'),
+                        help='Valid range of the Y coordinates, also the extent of the occupancy grid')
+    parser.add_argument('--dropBadCoords',
+                        action='store_true',
+                        help='Drop the records with coordinates that are not finite or out of range')
+    parser.add_argument('--knownTags',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        metavar='TAG',
+                        help='Valid tag values, besides the unknown tag')
+    parser.add_argument('--minBeeSize',
+                        type=int,
+                        default=0,
+                        metavar='N',
+                        help='Only keep the bees with at least N records')
+    parser.add_argument('--minPathSize',
+                        type=int,
+                        default=0,
+                        metavar='N',
+                        help='Only keep the paths with at least N records')
+    parser.add_argument('--categories',
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        metavar='CAT',
+                        help='Only keep the bees classified in these categories')
+    parser.add_argument('--frames',
+                        type=int,
+                        nargs=2,
+                        default=None,
+                        metavar=('FIRST', 'LAST'),
+                        help='Only keep the records within this frame window')
+    parser.add_argument('--region',
+                        type=float,
+                        nargs=4,
+                        default=None,
+                        metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX'),
+                        help='Only keep the records within this region')
+    parser.add_argument('-s',
+                        '--stitch',
+                        action='store_true',
+                        help='Join the bees split by tracker id switches')
+    parser.add_argument('--stitchDistance',
+                        type=float,
+                        default=20.0,
+                        metavar='D',
+                        help='Maximum distance between the end and start of stitched bees')
+    parser.add_argument('--stitchGap',
+                        type=int,
+                        default=10,
+                        metavar='N',
+                        help='Maximum number of frames between the end and start of stitched bees')
+    parser.add_argument('-w',
+                        '--window',
+                        type=int,
+                        default=100,
+                        metavar='N',
+                        help='Number of frames per window of the time series plots')
+    parser.add_argument('--noLedger',
+                        action='store_true',
+                        help='Do not record the jobs in a ledger, always recompute everything')
+    parser.add_argument('--maxAttempts',
+                        type=int,
+                        default=3,
+                        metavar='N',
+                        help='Maximum number of attempts for a failed recording')
+    parser.add_argument('--staleAfter',
+                        type=float,
+                        default=None,
+                        metavar='SECONDS',
+                        help='Reclaim recordings marked as running for longer than this')
     args = parser.parse_args()
+    for name, valueRange in (('--xRange', args.xRange), ('--yRange', args.yRange)):
+        if not valueRange is None and valueRange[0] >= valueRange[1]:
+            parser.error('%s: MIN must be smaller than MAX' % name)
+    if args.stitch and args.stitchGap < 1:
+        parser.error('--stitchGap must be at least 1')
+    if args.stitch and args.stitchDistance <= 0:
+        parser.error('--stitchDistance must be positive')
     return args
 
-def computeData(args):
-    worker = StatsWorker(args)
+def needsPandas(args):
+    '''Whether some of the input files are read with pandas, with the same
+    test as io_csv.loadCSVTable
+    '''
+    if args.noData or args.engine == 'numpy':
+        return False
+    if args.engine == 'pandas':
+        return True
+    return not all(bee_tracker.io_csv.usesNumPy(x, args.threads) for x in args.input)
+
+def makePool(args):
+    '''Forks the worker processes once, after the modules they need have
+    been imported, so that they do not import them again
+    '''
     if args.processes < 1:
+        return None
+    if needsPandas(args):
+        import pandas
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork').Pool(processes=args.processes)
+    return multiprocessing.Pool(processes=args.processes)
+
+def computeData(args, pool):
+    '''Computes the statistics of all the inputs.
+    Returns False if some of them failed or are still running elsewhere.
+    '''
+    worker = StatsWorker(args)
+    names  = [os.path.basename(x) for x in args.input]
+    if not args.noLedger:
+        ledger = bee_tracker.job_ledger.JobLedger(args.outDir)
+        ledger.register(names)
+    if pool is None:
         for path in args.input:
             worker.work(path)
     else:
-        pool = multiprocessing.Pool(processes=args.processes)
         pool.map(worker.work, args.input, chunksize=1)
+    if not args.noLedger:
+        counts = ledger.summary()
+        sys.stderr.write('Jobs: %s\n' % ', '.join('%d %s' % (counts[x], x) for x in sorted(counts)))
+        for name, host, pid in ledger.running():
+            sys.stderr.write('[WARNING] job %s still marked as running by process %s on %s, '
+                             'use --staleAfter to reclaim it if that process is gone\n' %
+                             (name, pid, host))
+        states = ledger.states(names)
+        failed = [x for x in names if states[x] != bee_tracker.job_ledger.JobLedger.DONE]
+        if len(failed) > 0:
+            sys.stderr.write('[ERROR] %d recordings not done: %s\n' %
+                             (len(failed), ', '.join(failed)))
+            return False
+    return True
 
-def makePlots(args):
+def makePlots(args, pool):
+    import matplotlib
+    matplotlib.use('Agg')
+    import bee_tracker.qc_plot
 
     def dirKey(key):
-        return int(key.replace('.csv', ''))
+        # Also strips the compression extension, e.g. 12.csv.gz
+        return int(key.split('.')[0])
 
     basenames   = [os.path.basename(x) for x in args.input]
     basenames   = sorted(basenames, key=dirKey)
@@ -126,18 +352,53 @@ def makePlots(args):
                                                     minCount=10)
         p.makePlots()
         index.addPlotsLink(p, handle)
+        p = bee_tracker.qc_plot.WindowedPlots(bee_tracker.qc_stats.FrameCounts,
+                                              directories,
+                                              args.outDir,
+                                              window=args.window)
+        p.makePlots()
+        index.addPlotsLink(p, handle)
+        p = bee_tracker.qc_plot.OccupancyPlots(bee_tracker.qc_stats.Occupancy,
+                                               directories,
+                                               args.outDir,
+                                               pool=pool)
+        p.makePlots()
+        index.addPlotsLink(p, handle)
+        aggregates = [(bee_tracker.qc_stats.BeesPerFrame,       False),
+                      (bee_tracker.qc_stats.FramesPerBee,       True),
+                      (bee_tracker.qc_stats.FramesPerPath,      True),
+                      (bee_tracker.qc_stats.FramesBetweenPaths, True),
+                      (bee_tracker.qc_stats.PathsPerBee,        True),
+                      (bee_tracker.qc_stats.Classification,     False)]
+        for stat, logScale in aggregates:
+            p = bee_tracker.qc_plot.AggregatePlots(stat,
+                                                   directories,
+                                                   args.outDir,
+                                                   logScale=logScale,
+                                                   pool=pool)
+            p.makePlots()
+            index.addPlotsLink(p, handle)
         index.writeHTMLFooter(handle)
 
 def main(args):
-    if not args.noData:
-        computeData(args)
+    '''Returns the exit status
+    '''
+    pool   = makePool(args)
+    status = 0
+    if not args.noData and not computeData(args, pool):
+        status = 1
     if not args.noPlot:
-        makePlots(args)
+        makePlots(args, pool)
+    if not pool is None:
+        pool.close()
+        pool.join()
+    return status
 
 if __name__ == '__main__':
     args  = parseArgs()
     if args.profile:
         import cProfile
-        cProfile.run('main(args)')
+        cProfile.run('status = main(args)')
     else:
-        main(args)
+        status = main(args)
+    sys.exit(status)
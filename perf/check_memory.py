@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+'''Memory regression check.
+Runs each stage of the processing of a synthetic recording of a given size
+and reports, per stage, the peak and retained memory allocated according to
+tracemalloc, and the peak increase of the resident set size. The tracemalloc
+figures are compared with the baselines in baselines.json.
+'''
+
+import argparse
+import gc
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Imported before any measurement so that the memory used by the modules
+# themselves is not attributed to the first stage using them
+import matplotlib
+matplotlib.use('Agg')
+import numpy
+import pandas
+
+import check_startup
+
+sys.path.insert(0, check_startup.ROOT_DIR)
+import bee_tracker.io_csv
+import bee_tracker.qc_plot
+import bee_tracker.qc_stats
+import bee_tracker.recording
+
+
+MB = float(1 << 20)
+
+def currentRSS():
+    '''Resident set size in bytes. Falls back to the peak resident set size
+    where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+class RSSSampler(threading.Thread):
+    '''Samples the resident set size in the background and keeps its maximum
+    '''
+
+    def __init__(self, interval=0.002):
+        threading.Thread.__init__(self)
+        self.daemon   = True
+        self.interval = interval
+        self.peak     = currentRSS()
+        self.running  = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, currentRSS())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.peak = max(self.peak, currentRSS())
+
+def measureStage(function, *args):
+    '''Runs a stage and returns its result and its memory figures in MB.
+    The result is kept alive by the caller, so the retained memory is what
+    the stage leaves behind for the next ones.
+    '''
+    gc.collect()
+    rssBefore = currentRSS()
+    tracemalloc.reset_peak()
+    before    = tracemalloc.get_traced_memory()[0]
+    sampler   = RSSSampler()
+    sampler.start()
+    result    = function(*args)
+    sampler.stop()
+    current, peak = tracemalloc.get_traced_memory()
+    figures   = {'peak_mb'    : (peak - before) / MB,
+                 'retained_mb': (current - before) / MB,
+                 'rss_peak_mb': (sampler.peak - rssBefore) / MB}
+    return result, figures
+
+def recordingBees(table):
+    recording = bee_tracker.recording.Recording(table)
+    recording.classify()
+    return recording.select().bees()
+
+def computeStat(stat, bees):
+    instance = stat(bees)
+    instance.compute()
+    return instance
+
+def preparePlots(instance, tmpDir):
+    directory = os.path.join(tmpDir, '1.csv')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    instance.write(directory)
+    plots = bee_tracker.qc_plot.CountsPerCategoryPlots(type(instance), [directory], tmpDir)
+    plots.prepare()
+    return plots
+
+def runStages(path, tmpDir):
+    '''Runs all the stages and returns their memory figures, in order
+    '''
+    stages  = []
+    kept    = []
+    stats   = [bee_tracker.qc_stats.BeesPerFrame,
+               bee_tracker.qc_stats.FramesPerBee,
+               bee_tracker.qc_stats.FramesPerPath,
+               bee_tracker.qc_stats.FramesBetweenPaths,
+               bee_tracker.qc_stats.PathsPerBee,
+               bee_tracker.qc_stats.Classification,
+               bee_tracker.qc_stats.FrameCounts,
+               bee_tracker.qc_stats.Occupancy]
+
+    def stage(name, function, *args):
+        result, figures = measureStage(function, *args)
+        kept.append(result)
+        stages.append((name, figures))
+        return result
+
+    table     = stage('load_table', bee_tracker.io_csv.loadCSVTable, path, 1, 'numpy')
+    df        = stage('load_dataframe', bee_tracker.io_csv.loadCSVDataFrame, path)
+    table, _  = stage('normalize', bee_tracker.io_csv.normalizeDataFrame, table)
+    stage('create_bees_groupby', bee_tracker.io_csv.createBeesFromDataFrame, df)
+    bees      = stage('recording_bees', recordingBees, table)
+    instances = {}
+    for stat in stats:
+        instances[stat] = stage('stat_' + stat.name, computeStat, stat, bees)
+    stage('plots_prepare',
+          preparePlots,
+          instances[bee_tracker.qc_stats.FramesPerPath],
+          tmpDir)
+    return stages
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Check the memory used by each processing stage against the baselines')
+    parser.add_argument('-b',
+                        '--bees',
+                        type=int,
+                        default=200,
+                        metavar='N',
+                        help='Number of bees of the synthetic recording')
+    parser.add_argument('-f',
+                        '--frames',
+                        type=int,
+                        default=2000,
+                        metavar='N',
+                        help='Number of frames of the synthetic recording')
+    parser.add_argument('-t',
+                        '--tolerance',
+                        type=float,
+                        default=1.25,
+                        metavar='F',
+                        help='Maximum ratio between a measurement and its baseline')
+    parser.add_argument('-s',
+                        '--slack',
+                        type=float,
+                        default=1.0,
+                        metavar='MB',
+                        help='Differences below this amount are never reported as regressions')
+    parser.add_argument('-u',
+                        '--update',
+                        action='store_true',
+                        help='Record the measurements as the new baselines')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    key  = '%dx%d' % (args.bees, args.frames)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'recording.csv')
+        check_startup.writeRecording(path, args.bees, args.frames)
+        tracemalloc.start()
+        stages = runStages(path, tmpDir)
+        tracemalloc.stop()
+    baselines = check_startup.loadBaselines()
+    memory    = baselines.get('memory', {}).get(key, {})
+    failed    = False
+    sys.stderr.write('%-28s %10s %12s %12s\n' % ('stage', 'peak_mb', 'retained_mb', 'rss_peak_mb'))
+    for name, figures in stages:
+        status = 'NEW'
+        if name in memory:
+            status = 'OK'
+            for figure in ('peak_mb', 'retained_mb'):
+                limit = max(memory[name][figure] * args.tolerance,
+                            memory[name][figure] + args.slack)
+                if figures[figure] > limit:
+                    status = 'FAIL'
+                    failed = True
+        sys.stderr.write('%-28s %10.2f %12.2f %12.2f [%s]\n' %
+                         (name,
+                          figures['peak_mb'],
+                          figures['retained_mb'],
+                          figures['rss_peak_mb'],
+                          status))
+    if args.update:
+        # The resident set size is too noisy to be checked, only the
+        # tracemalloc figures are recorded
+        memory = dict((name, {'peak_mb'    : round(figures['peak_mb'], 2),
+                              'retained_mb': round(figures['retained_mb'], 2)})
+                      for name, figures in stages)
+        baselines.setdefault('memory', {})[key] = memory
+        check_startup.saveBaselines(baselines)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+'''Startup time regression check.
+Measures, in fresh interpreters, the time taken to import the modules used
+to compute the statistics and to run basic_qc.py on a small recording
+without plots, checks that pandas and matplotlib are not imported on that
+path, and compares the timings with the baselines in baselines.json.
+'''
+
+import argparse
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+
+PERF_DIR     = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR     = os.path.dirname(PERF_DIR)
+BASELINES    = os.path.join(PERF_DIR, 'baselines.json')
+STATS_IMPORT = ('import sys\n'
+                'import bee_tracker.io_csv\n'
+                'import bee_tracker.job_ledger\n'
+                'import bee_tracker.qc_stats\n'
+                'import bee_tracker.recording\n'
+                'import bee_tracker.stitching\n'
+                'heavy = [x for x in ("pandas", "matplotlib") if x in sys.modules]\n'
+                'sys.stdout.write(",".join(heavy))\n')
+
+def writeRecording(path, nBees=50, nFrames=200, seed=0):
+    '''Writes a small synthetic recording
+    '''
+    rng = numpy.random.RandomState(seed)
+    with open(path, 'w') as handle:
+        handle.write('BeeID,Tag,Frame,X,Y\n')
+        for beeId in range(nBees):
+            start = rng.randint(0, nFrames)
+            for frame in range(start, start + rng.randint(1, nFrames)):
+                handle.write('%d,%d,%d,%.2f,%.2f\n' % (beeId,
+                                                       rng.randint(0, 3),
+                                                       frame,
+                                                       rng.uniform(0, 1000),
+                                                       rng.uniform(0, 1000)))
+
+def run(command, env):
+    '''Runs a command and returns its wall time and standard output
+    '''
+    start  = time.time()
+    output = subprocess.check_output(command, env=env, stderr=subprocess.DEVNULL)
+    return time.time() - start, output.decode()
+
+def measure(repeats):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR, env.get('PYTHONPATH', '')])
+    results = {}
+    # Best of several runs, as we only care about the unavoidable cost
+    times = []
+    for i in range(repeats):
+        elapsed, heavy = run([sys.executable, '-c', STATS_IMPORT], env)
+        times.append(elapsed)
+    results['import_seconds'] = min(times)
+    results['heavy_modules']  = [x for x in heavy.split(',') if x]
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path  = os.path.join(tmpDir, '1.csv')
+        writeRecording(path)
+        times = []
+        for i in range(repeats):
+            command = [sys.executable,
+                       os.path.join(ROOT_DIR, 'bin', 'basic_qc.py'),
+                       '--noPlot',
+                       '--noLedger',
+                       '-o', os.path.join(tmpDir, 'out'),
+                       path]
+            elapsed, output = run(command, env)
+            times.append(elapsed)
+        results['basic_qc_seconds'] = min(times)
+    return results
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Check the startup time of basic_qc against the baselines')
+    parser.add_argument('-n',
+                        '--repeats',
+                        type=int,
+                        default=5,
+                        metavar='N',
+                        help='Number of runs of each measurement')
+    parser.add_argument('-t',
+                        '--tolerance',
+                        type=float,
+                        default=1.5,
+                        metavar='F',
+                        help='Maximum ratio between a measurement and its baseline')
+    parser.add_argument('-u',
+                        '--update',
+                        action='store_true',
+                        help='Record the measurements as the new baselines')
+    return parser.parse_args()
+
+def loadBaselines():
+    if not os.path.exists(BASELINES):
+        return {}
+    with open(BASELINES) as handle:
+        return json.load(handle)
+
+def saveBaselines(baselines):
+    with open(BASELINES, 'w') as handle:
+        json.dump(baselines, handle, indent=4, sort_keys=True)
+        handle.write('\n')
+
+def main():
+    args      = parseArgs()
+    results   = measure(args.repeats)
+    baselines = loadBaselines()
+    failed    = False
+    if len(results['heavy_modules']) > 0:
+        sys.stderr.write('[FAIL] statistics modules import %s\n' %
+                         ', '.join(results['heavy_modules']))
+        failed = True
+    if args.update:
+        baselines['startup'] = {'import_seconds'  : round(results['import_seconds'], 3),
+                                'basic_qc_seconds': round(results['basic_qc_seconds'], 3)}
+        saveBaselines(baselines)
+    for key in ('import_seconds', 'basic_qc_seconds'):
+        baseline = baselines.get('startup', {}).get(key)
+        status   = 'OK'
+        if not baseline is None and results[key] > baseline * args.tolerance:
+            status = 'FAIL'
+            failed = True
+        sys.stderr.write('[%s] %s: %.3f (baseline %s)\n' %
+                         (status, key, results[key], baseline))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()